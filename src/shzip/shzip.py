@@ -1,112 +1,502 @@
+import io
 import os
+import bz2
 import sys
+import lzma
+import zlib
 import stat
 import shlex
+import random
 import typing
 import base64
+import shutil
+import tempfile
 import argparse
-import subprocess
+import functools
+import itertools
+import threading
+import collections
+import concurrent.futures
 
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
 
-def process_path(path: str, dereference: bool, files: typing.Set[str], directories: typing.Set[str], symlinks: typing.Set[str]) -> None:
-    # Make sure the path does not already exist
-    if path in files or path in directories or path in symlinks:
-        return
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Size of the chunks files are streamed in, a multiple of 3 so that encoding plain chunks carries nothing over
+CHUNK_SIZE = 3 << 18
 
-    # Stat the path to check type
-    stat_result = os.stat(path, follow_symlinks=dereference)
+# Size of the buffer of the output file
+OUTPUT_BUFFER_SIZE = 1 << 20
 
-    # If the path is a symlink, add a symlink
-    if stat.S_ISLNK(stat_result.st_mode):
-        # Add the path to the symlinks set
-        symlinks.add((path, os.readlink(path)))
+# Number of script lines joined into a single write
+LINES_PER_WRITE = 4096
 
-        # Add the parent directory path to the directories set
-        directories.add(os.path.dirname(path))
-    elif stat.S_ISREG(stat_result.st_mode):
-        # Add the path to the files set
-        files.add(path)
+# Maximal number and total size of arguments passed to a single command, well below ARG_MAX
+ARGUMENTS_PER_COMMAND = 1000
+ARGUMENTS_SIZE_PER_COMMAND = 1 << 16
 
-        # Add the parent directory path to the directories set
-        directories.add(os.path.dirname(path))
-    elif stat.S_ISDIR(stat_result.st_mode):
-        # List the files in the directory and handle them all
-        for child in os.listdir(path):
-            process_path(os.path.join(path, child), dereference, files, directories, symlinks)
+# Minimal number of files for which archiving concurrently pays off
+PARALLEL_THRESHOLD = 4
 
+# Characters which may be written as-is inside of a here-document
+TEXT_CHARACTERS = b"\t\n" + bytes(range(32, 128))
 
-def process_file(path: str, arguments: argparse.Namespace, output_file: typing.BinaryIO) -> None:
-    # Open the file for reading
-    with open(path, "rb") as file:
-        # Fetch file contents
-        contents = file.read()
+# Number of file separation magics to choose from
+MAGIC_CANDIDATES = 16
+
+# Per-thread hyperscan scratch spaces
+THREAD_STATE = threading.local()
+
+# Generator for file separation magics, seeded once from the system's randomness
+MAGIC_RANDOM = random.Random(os.urandom(32))
+
+# Templates of the script lines written for every archived path
+MKDIR_TEMPLATE = b"mkdir -p %b\n"
+TARGET_PATH_TEMPLATE = b"$TARGET/%b"
+SYMLINK_TEMPLATE = b"ln -s %b $TARGET/%b\n"
+HARDLINK_TEMPLATE = b"ln $TARGET/%b $TARGET/%b\n"
+EMPTY_FILE_TEMPLATE = b": > $TARGET/%b\n"
+DUMP_TEMPLATE = b"( head -c -1 | %b ) > $TARGET/%b << %b\n"
+TERMINATION_TEMPLATE = b"\n%b\n"
+
+# Characters the shell interprets inside of a here-document and their escaped form, backslashes must be escaped first
+ESCAPE_SEQUENCES = [(b"\\", b"\\\\"), (b"$", b"\\$"), (b"`", b"\\`")]
+
+
+def process_paths(paths: typing.Iterable[str], dereference: bool, files: typing.Dict[str, os.stat_result], directories: typing.Set[str], symlinks: typing.Set[typing.Tuple[str, str]], hardlinks: typing.Set[typing.Tuple[str, str]]) -> None:
+    # Paths and stat results of every multiply-linked inode
+    inodes = collections.defaultdict(dict)
+
+    # Create a stack of paths and their directory entries to handle
+    stack = collections.deque((path, None) for path in paths)
+
+    while stack:
+        # Pop the next path to handle
+        path, entry = stack.pop()
+
+        # Make sure the path does not already exist
+        if path in files or path in directories:
+            continue
+
+        # Stat the path to check type, directory entries already carry a cached stat
+        stat_result = entry.stat(follow_symlinks=dereference) if entry else os.stat(path, follow_symlinks=dereference)
+
+        # If the path is a symlink, add a symlink
+        if stat.S_ISLNK(stat_result.st_mode):
+            # Add the path to the symlinks set
+            symlinks.add((path, os.readlink(path)))
+
+            # Add the parent directory path to the directories set
+            directories.add(os.path.dirname(path))
+        elif stat.S_ISREG(stat_result.st_mode):
+            # Multiply-linked files are grouped by inode, otherwise add the path and its stat result to the files dictionary
+            if stat_result.st_nlink > 1:
+                inodes[(stat_result.st_dev, stat_result.st_ino)][path] = stat_result
+            else:
+                files[path] = stat_result
+
+            # Add the parent directory path to the directories set
+            directories.add(os.path.dirname(path))
+        elif stat.S_ISDIR(stat_result.st_mode):
+            # Scan the directory and push all of its entries
+            with os.scandir(path) as entries:
+                stack.extend((child.path, child) for child in entries)
+
+    for linked_paths in inodes.values():
+        # Archive the smallest path of every inode, so that the choice does not depend on the traversal order
+        primary = min(linked_paths)
+        files[primary] = linked_paths[primary]
+
+        # Link all other paths to it
+        hardlinks.update((path, primary) for path in linked_paths if path != primary)
+
+
+def leaf_directories(directories: typing.Set[str]) -> typing.Set[str]:
+    # Collect the ancestors of all directories
+    ancestors = set()
+
+    for directory in directories:
+        # Walk up until reaching the root or an ancestor which was already collected
+        parent = os.path.dirname(directory)
+
+        while parent != directory and parent not in ancestors:
+            ancestors.add(parent)
+            directory, parent = parent, os.path.dirname(parent)
+
+    # Only directories which are not ancestors of other directories remain
+    return directories - ancestors
+
+
+@functools.lru_cache(maxsize=65536)
+def quote_path(path: str) -> bytes:
+    # Quote the path relative to the target directory
+    return os.fsencode(shlex.quote(path.lstrip("./")))
+
+
+def escape_contents(contents: bytes) -> bytes:
+    # Escape all characters the shell interprets inside of a here-document
+    for character, escaped_character in ESCAPE_SEQUENCES:
+        contents = contents.replace(character, escaped_character)
+
+    # Return the escaped contents
+    return contents
+
+
+def generate_magics(reproducable: bool) -> typing.Tuple[bytes, ...]:
+    # Reproducable archives use a fixed series of magics
+    if reproducable:
+        return (b"SHZIP_EOF",) + tuple(b"SHZIP_EOF_%d" % index for index in range(1, MAGIC_CANDIDATES))
+
+    # Otherwise, draw random magics, once per archive
+    return tuple(b"%020x" % MAGIC_RANDOM.getrandbits(80) for _ in range(MAGIC_CANDIDATES))
+
+
+@functools.lru_cache(maxsize=64)
+def compile_magics(magic_lines: typing.Tuple[bytes, ...]) -> typing.Any:
+    # Compile all magic lines into a single literal database
+    database = hyperscan.Database(mode=hyperscan.HS_MODE_BLOCK)
+    database.compile(expressions=list(magic_lines), ids=list(range(len(magic_lines))), elements=len(magic_lines), flags=hyperscan.HS_FLAG_SINGLEMATCH, literal=True)
+
+    # Return the compiled database
+    return database
+
+
+def find_magics(contents: bytes, magic_lines: typing.Tuple[bytes, ...]) -> typing.Set[int]:
+    # Without hyperscan, search for every magic line separately
+    if not hyperscan:
+        return {index for index, magic_line in enumerate(magic_lines) if magic_line in contents}
+
+    # Fetch the database and this thread's scratch space for it
+    database = compile_magics(magic_lines)
+    scratches = THREAD_STATE.__dict__.setdefault("scratches", {})
+
+    # Scratch spaces may not be shared between threads
+    if magic_lines not in scratches:
+        scratches[magic_lines] = hyperscan.Scratch(database)
+
+    # Scan for all magic lines at once
+    found = set()
+    database.scan(contents, match_event_handler=lambda index, *_: found.add(index), scratch=scratches[magic_lines])
+
+    # Return the indices of the magic lines found
+    return found
+
+
+def read_chunks(file: typing.BinaryIO, buffer: bytearray) -> typing.Iterator[bytearray]:
+    while True:
+        # Read the next chunk into the buffer
+        length = file.readinto(buffer)
+
+        # Stop at the end of the file
+        if not length:
+            return
+
+        # Yield the filled part of the buffer, only a partial chunk is copied
+        yield buffer if length == len(buffer) else buffer[:length]
+
+
+def scan_magics(file: typing.BinaryIO, buffer: bytearray, eof_magics: typing.Tuple[bytes, ...]) -> typing.Tuple[bool, bool, typing.Set[int]]:
+    # The separation magics as they would appear as lines of the contents
+    magic_lines = tuple(b"\n" + eof_magic + b"\n" for eof_magic in eof_magics)
+
+    # Length of the longest magic line, used to check chunk boundaries
+    boundary = max(map(len, magic_lines))
+
+    # The end of the previous chunk, the contents start on a new line
+    tail = b"\n"
+
+    # Indices of the magics appearing in the contents
+    found = set()
+
+    # Whether any character has to be escaped
+    requires_escaping = False
+
+    for chunk in read_chunks(file, buffer):
+        # Any non-printable or non-ASCII character is left over after deleting the text characters
+        if chunk.translate(None, TEXT_CHARACTERS):
+            return True, False, found
+
+        # Find the magics appearing as lines, including across chunk boundaries
+        found |= find_magics(chunk, magic_lines) | find_magics(tail + chunk[:boundary], magic_lines)
+
+        # If every magic appears, there is no point in scanning further
+        if len(found) == len(magic_lines):
+            return False, requires_escaping, found
+
+        # Check whether the chunk contains characters the shell interprets
+        requires_escaping = requires_escaping or any(character in chunk for character, _ in ESCAPE_SEQUENCES)
+
+        # Keep the end of the chunk for the next boundary check
+        tail = (tail + chunk[-boundary:])[-boundary:]
+
+    # The contents are followed by a newline before the separation magic
+    found |= find_magics(tail + b"\n", magic_lines)
+
+    # Return the indices of the magics found
+    return False, requires_escaping, found
+
+
+def scan_contents(file: typing.BinaryIO, buffer: bytearray, eof_magics: typing.Tuple[bytes, ...]) -> typing.Tuple[bool, bool, bytes]:
+    # Indices of the magics not known to appear in the contents
+    remaining = list(range(len(eof_magics)))
+
+    while remaining:
+        # Hyperscan searches for all magics at once, otherwise only search for the first one and rescan on the rare collision
+        searched = remaining if hyperscan else remaining[:1]
+
+        # Scan the contents from the start
+        file.seek(0)
+        requires_encoding, requires_escaping, found = scan_magics(file, buffer, tuple(eof_magics[index] for index in searched))
+
+        # Binary contents must be encoded
+        if requires_encoding:
+            return True, False, eof_magics[0]
 
-    if not contents:
+        # Drop the magics which appear in the contents
+        remaining = [index for position, index in enumerate(searched) if position not in found] + remaining[len(searched):]
+
+        # Pick the first magic known not to appear in the contents
+        if remaining and remaining[0] in searched:
+            return False, requires_escaping, eof_magics[remaining[0]]
+
+    # Every magic appears, the contents must be encoded
+    return True, False, eof_magics[0]
+
+
+def copy_contents(file: typing.BinaryIO, output_file: typing.BinaryIO) -> None:
+    # Only regular buffered files can be written to directly by the kernel
+    if hasattr(os, "sendfile") and isinstance(output_file, io.BufferedWriter):
+        # Write out anything buffered before bypassing the buffer
+        output_file.flush()
+
+        # Copy the contents from the current position to the end of the file
+        offset, size = file.tell(), os.fstat(file.fileno()).st_size
+
+        try:
+            while offset < size:
+                # Send the next part of the file
+                sent = os.sendfile(output_file.fileno(), file.fileno(), offset, size - offset)
+
+                # Stop if the file was truncated
+                if not sent:
+                    return
+
+                # Advance the offset
+                offset += sent
+
+            # Nothing more to do
+            return
+        except OSError:
+            # Some outputs do not support sendfile, fall back if nothing was sent yet
+            if offset != file.tell():
+                raise
+
+    # Copy the contents through userspace
+    shutil.copyfileobj(file, output_file, CHUNK_SIZE)
+
+
+class EscapingWriter:
+
+    def __init__(self, output_file: typing.BinaryIO) -> None:
+        # Store the output file
+        self.output_file = output_file
+
+    def write(self, contents: bytes) -> None:
+        # Escape the contents on their way to the output file
+        self.output_file.write(escape_contents(contents))
+
+    def close(self) -> None:
+        # Nothing is buffered, the output file is left open
+        pass
+
+
+class EncodingWriter:
+
+    def __init__(self, output_file: typing.BinaryIO) -> None:
+        # Store the output file
+        self.output_file = output_file
+
+        # Contents which could not be encoded without padding yet
+        self.pending = b""
+
+    def write(self, contents: bytes) -> None:
+        # Prepend the contents left over from the previous write
+        if self.pending:
+            contents = self.pending + contents
+
+        # Encode as much of the contents as possible without padding
+        aligned = len(contents) - len(contents) % 3
+
+        # Write the encoded contents and keep the rest for later
+        self.output_file.write(base64.b64encode(memoryview(contents)[:aligned]))
+        self.pending = contents[aligned:]
+
+    def close(self) -> None:
+        # Encode whatever is left, the output file is left open
+        self.output_file.write(base64.b64encode(self.pending))
+
+
+class CompressingWriter:
+
+    def __init__(self, compressor: typing.Any, output_file: typing.Union[EscapingWriter, EncodingWriter]) -> None:
+        # Store the compressor and the output file
+        self.compressor = compressor
+        self.output_file = output_file
+
+    def write(self, contents: bytes) -> None:
+        # Compress the contents on their way to the output file
+        self.output_file.write(self.compressor.compress(contents))
+
+    def close(self) -> None:
+        # Flush the compressor and close the underlying writer
+        self.output_file.write(self.compressor.flush())
+        self.output_file.close()
+
+
+def process_file(path: str, arguments: argparse.Namespace, eof_magics: typing.Tuple[bytes, ...], output_file: typing.BinaryIO, stat_result: os.stat_result) -> None:
+    # Check whether the file has any contents
+    if not stat_result.st_size:
         # If contents are empty, just create the file
-        output_file.write(f'echo > $TARGET/{shlex.quote(path.lstrip("./"))}'.encode())
+        output_file.write(EMPTY_FILE_TEMPLATE % quote_path(path))
 
         # Nothing more to do
         return
 
     # Initialize filter
+    compressor = None
     decoding_command = None
     decompression_command = None
 
     # Decide on a compression filter
     if arguments.gzip:
         # Set the decompression command
-        decompression_command = "( gzip -d || gunzip )"
+        decompression_command = b"( gzip -d || gunzip )"
 
-        # Compress the contents using gzip
-        contents = subprocess.run(["gzip", "-9"], input=contents, capture_output=True, check=True).stdout
+        # Create a gzip compressor
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
     elif arguments.bzip2:
         # Set the decompression command
-        decompression_command = "( bzip2 -d || bzcat )"
+        decompression_command = b"( bzip2 -d || bzcat )"
 
-        # Compress the contents using bzip2
-        contents = subprocess.run(["bzip2"], input=contents, capture_output=True, check=True).stdout
+        # Create a bzip2 compressor
+        compressor = bz2.BZ2Compressor(9)
     elif arguments.xz:
         # Set the decompression command
-        decompression_command = "( xz -d || unxz )"
+        decompression_command = b"( xz -d || unxz )"
 
-        # Compress the contents using xz
-        contents = subprocess.run(["xz", "-e9"], input=contents, capture_output=True, check=True).stdout
+        # Create an xz compressor
+        compressor = lzma.LZMACompressor(preset=9 | lzma.PRESET_EXTREME)
+    elif arguments.zstd:
+        # Set the decompression command
+        decompression_command = b"( zstd -d || unzstd )"
 
-    # Will the input be encoded using base64?
-    if min(contents) <= 32 or max(contents) >= 128:
-        # Set the decoding command
-        decoding_command = "base64 -d"
+        # Create a multi-threaded zstd compressor
+        compressor = zstandard.ZstdCompressor(level=19, threads=-1).compressobj()
 
-        # Encode the contents
-        contents = base64.b64encode(contents)
+    # Open the file for reading
+    with open(path, "rb") as file:
+        # Let the kernel know the file will be read sequentially, and soon
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+
+        # Create a buffer to read the file into, no larger than the file itself
+        buffer = bytearray(min(stat_result.st_size, CHUNK_SIZE))
+
+        # Scan the contents to decide how to write them, compressed contents are always binary
+        requires_encoding, requires_escaping, eof_magic = (True, False, eof_magics[0]) if compressor else scan_contents(file, buffer, eof_magics)
+
+        # Will the input be encoded using base64?
+        if requires_encoding:
+            # Set the decoding command
+            decoding_command = b"base64 -d"
+
+        # Rewind the file after scanning it
+        file.seek(0)
+
+        # Join all of the commands
+        filter_command = b" | ".join(filter(bool, [decoding_command, decompression_command]))
+
+        # Write the dumping function
+        output_file.write(DUMP_TEMPLATE % (filter_command or b"cat", quote_path(path), eof_magic))
 
-    # Join all of the commands
-    filter_command = " | ".join(filter(bool, [decoding_command, decompression_command]))
+        # Contents which need no changes are copied as-is
+        if not requires_encoding and not requires_escaping:
+            copy_contents(file, output_file)
+        else:
+            # Create a writer which encodes or escapes the contents into the output file
+            writer = EncodingWriter(output_file) if requires_encoding else EscapingWriter(output_file)
 
-    # Generate file separation magic
-    eof_magic = os.urandom(10).hex()
-    
-    # If output should be reproducable, overwrite separation magic
-    if arguments.reproducable:
-        eof_magic = "SHZIP_EOF"
+            # Compress the contents before encoding them
+            if compressor:
+                writer = CompressingWriter(compressor, writer)
 
-    # Write the dumping function
-    output_file.write(f'( head -c -1 | {filter_command or "cat"} ) > $TARGET/{shlex.quote(path.lstrip("./"))} << {eof_magic}\n'.encode())
+            # Stream the contents through the writer
+            for chunk in read_chunks(file, buffer):
+                writer.write(chunk)
 
-    # Write the contents
-    output_file.write(contents)
+            # Flush the writer
+            writer.close()
 
     # Write the termination string
-    output_file.write(f'\n{eof_magic}\n'.encode())
+    output_file.write(TERMINATION_TEMPLATE % eof_magic)
+
+
+def dump_file(path: str, arguments: argparse.Namespace, eof_magics: typing.Tuple[bytes, ...], stat_result: os.stat_result) -> typing.BinaryIO:
+    # Create a temporary file to hold the archived file, kept in memory while it is small
+    temporary_file = tempfile.SpooledTemporaryFile(max_size=CHUNK_SIZE)
+
+    # Process the file contents into the temporary file
+    process_file(path, arguments, eof_magics, temporary_file, stat_result)
+
+    # Rewind the temporary file for reading
+    temporary_file.seek(0)
+
+    # Return the temporary file
+    return temporary_file
+
+
+def write_lines(lines: typing.Iterable[bytes], output_file: typing.BinaryIO) -> None:
+    # Create an iterator to take pages of lines from
+    iterator = iter(lines)
+
+    # Write the lines a page at a time
+    for page in iter(lambda: list(itertools.islice(iterator, LINES_PER_WRITE)), []):
+        output_file.write(b"".join(page))
+
+
+def group_arguments(arguments: typing.Iterable[bytes]) -> typing.Iterator[typing.List[bytes]]:
+    # Current group of arguments and its size
+    group, size = [], 0
+
+    for argument in arguments:
+        # Start a new group once the current group is full
+        if group and (len(group) >= ARGUMENTS_PER_COMMAND or size + len(argument) > ARGUMENTS_SIZE_PER_COMMAND):
+            yield group
+            group, size = [], 0
+
+        # Add the argument and its separator to the group
+        group.append(argument)
+        size += len(argument) + 1
+
+    # Yield the last group
+    if group:
+        yield group
 
 
 def check_prerequisites(prerequisites, arguments, output_file):
     if arguments.skip_prerequisites:
         return
-    
-    output_file.write(f'( {" || ".join(f"which {shlex.quote(prereqisite)}" for prereqisite in prerequisites)} ) || echo Unable to find prerequisites {shlex.quote(repr(prerequisites))}; exit 127'.encode())
 
-def main():
+    output_file.write(f'( {" || ".join(f"which {shlex.quote(prereqisite)}" for prereqisite in prerequisites)} ) > /dev/null || {{ echo Unable to find prerequisites {shlex.quote(repr(prerequisites))}; exit 127; }}\n'.encode())
+
+def main(argv: typing.Optional[typing.List[str]] = None, stdout: typing.Optional[typing.BinaryIO] = None) -> None:
     # Create argument parser
     parser = argparse.ArgumentParser(add_help=False)
 
@@ -114,12 +504,15 @@ def main():
     parser.add_argument('--reproducable', action='store_true', help='Create reproducable archives')
     parser.add_argument('--shell', type=str, action='store', help='Shell to use for the output file', default='/bin/sh')
     parser.add_argument('--target', type=str, action='store', help='Target directory for extraction', default='.')
+    parser.add_argument('--skip-prerequisites', action='store_true', help='Do not check for prerequisites when extracting')
+    parser.add_argument('--jobs', type=int, action='store', help='Number of files to archive concurrently, defaults to the number of CPUs when compressing')
 
     # Create compression group
     compression = parser.add_mutually_exclusive_group()
     compression.add_argument('-z', '--gzip', action='store_true', help='Compress files using gzip')
     compression.add_argument('-j', '--bzip2', action='store_true', help='Compress files using bzip2')
     compression.add_argument('-J', '--xz', action='store_true', help='Compress files using xz')
+    compression.add_argument('--zstd', action='store_true', help='Compress files using zstd')
 
     # Create validation group
     validation = parser.add_mutually_exclusive_group()
@@ -136,13 +529,17 @@ def main():
     parser.add_argument("paths", type=str, action='store', nargs="*", help="Paths to archive")
 
     # Parse the arguments
-    arguments = parser.parse_args()
+    arguments = parser.parse_args(argv)
+
+    # Make sure the zstd compressor is available
+    if arguments.zstd and not zstandard:
+        parser.error("--zstd requires the zstandard package")
 
     # Create a set of paths to loop over
     paths_to_process = set()
 
     # Lists of things to create
-    files_to_dump, directories_to_create, symlinks_to_link = set(), set(), set()
+    files_to_dump, directories_to_create, symlinks_to_link, hardlinks_to_link = dict(), set(), set(), set()
 
     # Add paths to process from args
     if arguments.paths:
@@ -161,16 +558,18 @@ def main():
     if arguments.directory:
         os.chdir(arguments.directory)
 
+    # Generate file separation magics to choose from, shared by all files of the archive
+    eof_magics = generate_magics(arguments.reproducable)
+
     # Process all paths
-    for path in paths_to_process:
-        process_path(path, arguments.dereference, files_to_dump, directories_to_create, symlinks_to_link)
+    process_paths(paths_to_process, arguments.dereference, files_to_dump, directories_to_create, symlinks_to_link, hardlinks_to_link)
 
     # Initialize the default output file
-    output_file = sys.stdout.buffer
+    output_file = stdout or sys.stdout.buffer
 
     # Open the output file
     if arguments.file:
-        output_file = open(arguments.file, "wb")
+        output_file = open(arguments.file, "wb", buffering=OUTPUT_BUFFER_SIZE)
 
     # Write the shebang
     output_file.write(f'#!{arguments.shell}\n'.encode())
@@ -185,22 +584,68 @@ def main():
     elif arguments.xz:
         # Write the decompressor check
         check_prerequisites(["xz", "unxz"], arguments, output_file)
+    elif arguments.zstd:
+        # Write the decompressor check
+        check_prerequisites(["zstd", "unzstd"], arguments, output_file)
 
     # Determine target path from environment
     output_file.write(f'test -z "$TARGET" && TARGET={shlex.quote(arguments.target)}\n'.encode())
 
-    # Create all directories
-    for directory_to_create in sorted(directories_to_create, key=len):
-        output_file.write(f'mkdir -p $TARGET/{shlex.quote(directory_to_create.lstrip("./"))}\n'.encode())
+    # Create all directories, parents are created along with their children
+    write_lines((MKDIR_TEMPLATE % b" ".join(group) for group in group_arguments(TARGET_PATH_TEMPLATE % quote_path(directory_to_create) for directory_to_create in sorted(leaf_directories(directories_to_create)))), output_file)
 
-    # Archive all files
-    for file_to_dump in files_to_dump:
-        # Process the file contents
-        process_file(file_to_dump, arguments, output_file)
+    # Sort the files so that the archive order is stable
+    files_to_dump = sorted(files_to_dump.items())
+
+    # Only compressors release the GIL, other contents are streamed in order unless asked otherwise
+    if arguments.jobs is None:
+        arguments.jobs = (os.cpu_count() or 1) if arguments.gzip or arguments.bzip2 or arguments.xz or arguments.zstd else 1
 
-    for symlink, target in symlinks_to_link:
-        # Create symlink to target
-        output_file.write(f'ln -s {shlex.quote(target)} $TARGET/{shlex.quote(symlink.lstrip("./"))}\n'.encode())
+    # Determine how many files to archive concurrently
+    jobs = min(arguments.jobs, os.cpu_count() or 1, len(files_to_dump))
+
+    # Archive all files
+    if jobs > 1 and len(files_to_dump) >= PARALLEL_THRESHOLD:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            # Files which are being processed, in archive order
+            futures = collections.deque()
+
+            try:
+                for index, (file_to_dump, stat_result) in enumerate(files_to_dump):
+                    # Process the file contents concurrently
+                    futures.append(executor.submit(dump_file, file_to_dump, arguments, eof_magics, stat_result))
+
+                    # Write the processed files in order, keeping a bounded number of files in flight
+                    while futures and (len(futures) > jobs * 2 or index == len(files_to_dump) - 1):
+                        with futures.popleft().result() as temporary_file:
+                            shutil.copyfileobj(temporary_file, output_file, CHUNK_SIZE)
+            finally:
+                # If writing failed, cancel the files which were not processed yet and wait for the rest
+                for future in futures:
+                    future.cancel()
+
+                concurrent.futures.wait(futures)
+
+                # Close the temporary files of the files which were processed but never written
+                for future in futures:
+                    if not future.cancelled() and not future.exception():
+                        future.result().close()
+    else:
+        for file_to_dump, stat_result in files_to_dump:
+            # Process the file contents
+            process_file(file_to_dump, arguments, eof_magics, output_file, stat_result)
+
+    # Create symlinks to targets
+    write_lines((SYMLINK_TEMPLATE % (os.fsencode(shlex.quote(target)), quote_path(symlink)) for symlink, target in sorted(symlinks_to_link)), output_file)
+
+    # Create hardlinks to archived files
+    write_lines((HARDLINK_TEMPLATE % (quote_path(target), quote_path(hardlink)) for hardlink, target in sorted(hardlinks_to_link)), output_file)
+
+    # Close the output file, or flush it if it is not ours to close
+    if arguments.file:
+        output_file.close()
+    else:
+        output_file.flush()
 
 
 if __name__ == '__main__':
@@ -1,124 +1,313 @@
+import io
 import os
 import sys
+import mmap
+import time
+import shlex
+import shutil
 import typing
 import pytest
 import hashlib
-import tempfile
+import selectors
+import threading
 import subprocess
+import contextlib
+import importlib.util
+import concurrent.futures
 
+from shzip import shzip as shzip_module
 
-def extract(file=None, contents=None, environment={}) -> str:
-    # Create an extraction path
-    temp_path = tempfile.mktemp()
+# Run shzip in a separate interpreter instead of in-process, for integration coverage
+SUBPROCESS = bool(os.environ.get("SHZIP_SUBPROCESS"))
 
-    # Create environment variables
-    env = {"TARGET": temp_path}
+# Command line prefix for running shzip in a separate interpreter, independent of the working directory
+SHZIP_COMMAND = (sys.executable, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, "src", "shzip", "shzip.py")))
+
+# Line printed by the shared shell after every extraction, followed by the exit status
+SENTINEL = b"SHZIP_EXTRACTED_%b" % os.urandom(8).hex().encode()
+
+# Seconds the shared shell may take to run a single extraction
+EXTRACTION_TIMEOUT = 60
+
+
+def feed(pipe: typing.BinaryIO, contents: bytes) -> None:
+    try:
+        # Write the contents, the reader may exit before consuming everything
+        pipe.write(contents)
+    except BrokenPipeError:
+        pass
+    finally:
+        # Signal end of input
+        pipe.close()
+
+
+@pytest.fixture(scope="session")
+def shared_shell():
+    # Start a single shell which runs every extraction of this worker
+    with subprocess.Popen(["/bin/sh"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, env={}) as process:
+        yield process
+
+
+@pytest.fixture
+def shell(shared_shell):
+    # Fail fast once an earlier extraction killed the shared shell
+    if shared_shell.poll() is not None:
+        pytest.fail(f"Shared shell exited with status {shared_shell.returncode} during an earlier test of this worker")
+
+    # Hand out the shared shell
+    return shared_shell
+
+
+def extract(shell: subprocess.Popen, extraction_path: str, file=None, contents=None, environment={}) -> str:
+    # Create environment variables, decompressors are found the way the tests find them
+    env = {"TARGET": extraction_path, "PATH": os.environ.get("PATH", os.defpath)}
     env.update(environment)
 
     # Make sure variables are defined
     assert file or contents, "Must pass file or contents"
 
-    if file:
-        # Make the file executable
-        os.chmod(file, 0o777)
+    # Write piped archives to a file, so that the shell parses them up to their own end
+    if not file:
+        file = os.path.join(os.path.dirname(extraction_path), "archive.sh")
+        write_file(file, contents)
+
+    # Export the variables, they only live as long as the subshell
+    assignments = b"".join(b"export %b=%b; " % (os.fsencode(key), os.fsencode(shlex.quote(value))) for key, value in env.items())
+
+    # Source the archive in a subshell of the shared shell, then report its exit status
+    shell.stdin.write(b"( %b. %b ) < /dev/null; echo %b $?\n" % (assignments, os.fsencode(shlex.quote(file)), SENTINEL))
+    shell.stdin.flush()
+
+    # Everything the shell printed so far
+    output = bytearray()
 
-        # Execute the archive
-        subprocess.run([file], env=env, capture_output=False, check=True)
-    else:
-        # Pipe the archive to a shell
-        subprocess.run(["/bin/sh"], input=contents, env=env, capture_output=False, check=True)
+    # Wait for the shell to finish extracting, but not forever
+    deadline = time.monotonic() + EXTRACTION_TIMEOUT
+
+    with selectors.DefaultSelector() as selector:
+        selector.register(shell.stdout, selectors.EVENT_READ)
+
+        while True:
+            # Stop once the whole sentinel line was printed
+            index = output.find(SENTINEL)
+            if index != -1 and output.find(b"\n", index) != -1:
+                break
+
+            # Give up on a stuck shell, it can not run any further extractions
+            if not selector.select(max(deadline - time.monotonic(), 0)):
+                shell.kill()
+                raise TimeoutError("Shell did not finish extracting")
+
+            # Read whatever is available, bypassing the pipe's buffer
+            chunk = os.read(shell.stdout.fileno(), 1 << 16)
+
+            if not chunk:
+                raise EOFError("Shell exited while extracting")
+
+            output.extend(chunk)
+
+    # Pass along anything else the archive printed
+    if index:
+        print(bytes(output[:index]))
+
+    # Parse the exit status following the sentinel
+    returncode = int(output[index:].split()[1])
+
+    # Make sure the extraction succeeded
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, "/bin/sh")
 
     # Return the extraction path
-    return temp_path
+    return extraction_path
 
 
-def shzip(*args, input: typing.Optional[bytes] = None) -> bytes:
-    # Execute shzip with the arguments
-    process = subprocess.run([sys.executable, "src/shzip/shzip.py"] + list(args), input=input, capture_output=True, check=False)
+def write_file(path: str, contents: bytes) -> None:
+    # Write the contents to a new file
+    with open(path, "wb") as file:
+        file.write(contents)
 
-    # Raise an exception if failed
-    if process.returncode != 0:
-        raise Exception(process.stderr)
-    
-    print(process.stdout)
 
-    # Return the stdout
-    return process.stdout
+def md5sum(path: str) -> bytes:
+    with open(path, "rb") as file:
+        # Hash the file without reading it into memory at once
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(file, "md5").digest()
 
+        # Fall back to hashing the file in chunks
+        md5 = hashlib.md5()
+        for chunk in iter(lambda: file.read(1 << 16), b""):
+            md5.update(chunk)
+
+        return md5.digest()
 
-def test_empty_archive():
-    # Create empty archive in file
-    with pytest.raises(Exception):
-        shzip()
 
+def shzip(*args, input: typing.Optional[bytes] = None) -> bytes:
+    if SUBPROCESS:
+        # Execute shzip with the arguments
+        with subprocess.Popen(SHZIP_COMMAND + args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as process:
+            # Feed the input from a separate thread
+            writer = threading.Thread(target=feed, args=(process.stdin, input or b""))
+            writer.start()
+
+            # Buffers for the standard streams, growing in place
+            stdout, stderr = bytearray(), bytearray()
+
+            # Drain both streams until they are closed
+            with selectors.DefaultSelector() as selector:
+                selector.register(process.stdout, selectors.EVENT_READ, stdout)
+                selector.register(process.stderr, selectors.EVENT_READ, stderr)
+
+                while selector.get_map():
+                    for key, _ in selector.select():
+                        # Read whatever is available on the stream
+                        chunk = os.read(key.fd, 1 << 16)
+
+                        if chunk:
+                            key.data.extend(chunk)
+                        else:
+                            selector.unregister(key.fileobj)
+
+            # Wait for shzip to exit
+            process.wait()
+            writer.join()
+
+        # Raise an exception if failed
+        if process.returncode != 0:
+            raise Exception(bytes(stderr))
+
+        # Return the stdout
+        return bytes(stdout)
+
+    # Create buffers for the standard streams
+    stdin, stdout, stderr = io.TextIOWrapper(io.BytesIO(input or b"")), io.BytesIO(), io.StringIO()
+
+    # Execute shzip with the arguments in-process
+    with contextlib.redirect_stderr(stderr), contextlib.ExitStack() as stack:
+        # Replace the standard input for the duration of the call
+        stack.callback(setattr, sys, "stdin", sys.stdin)
+        sys.stdin = stdin
+
+        try:
+            shzip_module.main(list(args), stdout)
+        except SystemExit as exit:
+            # Raise an exception if failed
+            if exit.code:
+                raise Exception(stderr.getvalue())
+
+    # Return the stdout
+    return stdout.getvalue()
 
-def test_archive_to_stdout():
+
+@pytest.fixture(scope="module")
+def hello_path(tmp_path_factory) -> str:
     # Create temporary file
-    temp_path = tempfile.mktemp()
+    temp_path = str(tmp_path_factory.mktemp("hello") / "file")
 
     # Write some data to the file
     with open(temp_path, "w") as file:
         file.write("HelloWorld")
 
+    # Share the file between the tests, tests are distributed individually so every worker running them creates its own
+    return temp_path
+
+
+def test_empty_archive():
+    # Create empty archive in file
+    with pytest.raises(Exception):
+        shzip()
+
+
+def test_archive_to_stdout(hello_path):
     # Archive the file
-    assert b"HelloWorld" in shzip(temp_path)
+    assert b"HelloWorld" in shzip(hello_path)
 
 
-def test_archive_to_file():
+def test_archive_to_file(shell, tmp_path, hello_path):
     # Create output path
-    output_path = tempfile.mktemp()
+    output_path = str(tmp_path / "archive")
 
-    # Create temporary file
-    temp_path = tempfile.mktemp()
+    # Archive the file
+    assert b"HelloWorld" not in shzip("-f", output_path, hello_path)
 
-    # Write some data to the file
-    with open(temp_path, "w") as file:
-        file.write("HelloWorld")
+    # Make sure the file exists and is an archive
+    with open(output_path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as contents:
+        assert contents.find(b"HelloWorld") != -1
 
-    # Archive the file
-    assert b"HelloWorld" not in shzip("-f", output_path, temp_path)
+    # Execute the archive to extract
+    extraction_path = extract(shell, str(tmp_path / "extract"), file=output_path)
 
     # Make sure the file exists
-    assert os.path.isfile(output_path)
+    assert os.path.isfile(os.path.join(extraction_path, hello_path.lstrip("./")))
 
-    # Make sure the file is an archive
-    with open(output_path, "rb") as file:
-        assert b"HelloWorld" in file.read()
 
-    # Execute the archive to extract
-    extraction_path = extract(file=output_path)
+def test_archive_executed(tmp_path, hello_path):
+    # Create output path
+    output_path = str(tmp_path / "archive")
 
-    # Make sure the file exists
-    assert os.path.isfile(os.path.join(extraction_path, temp_path.lstrip("./")))
+    # Archive the file with an explicit shell
+    shzip("--shell", "/bin/sh", "-f", output_path, hello_path)
 
+    # Make the archive executable
+    os.chmod(output_path, 0o755)
 
-def test_archive_multiple_files():
-    # List of temporary files
-    temp_paths = []
+    # Execute the archive through its shebang
+    extraction_path = str(tmp_path / "extract")
+    subprocess.run([output_path], env={"TARGET": extraction_path, "PATH": os.environ.get("PATH", os.defpath)}, check=True)
 
-    # Create temporary files
-    for index in range(10):
-        # Create current path
-        temp_path = tempfile.mktemp()
+    # Make sure the contents match
+    with open(os.path.join(extraction_path, hello_path.lstrip("./")), "r") as file:
+        assert file.read() == "HelloWorld"
 
-        # Write to the file
-        with open(temp_path, "w") as file:
-            file.write(os.urandom(11 * index).hex())
 
-        # Append the path to the list
-        temp_paths.append(temp_path)
+def test_archive_piped(tmp_path, hello_path):
+    # Pipe the archive to a shell reading it from the standard input
+    extraction_path = str(tmp_path / "extract")
+    subprocess.run(["/bin/sh"], input=shzip(hello_path), env={"TARGET": extraction_path, "PATH": os.environ.get("PATH", os.defpath)}, check=True)
+
+    # Make sure the contents match
+    with open(os.path.join(extraction_path, hello_path.lstrip("./")), "r") as file:
+        assert file.read() == "HelloWorld"
+
+
+def test_archive_missing_prerequisites(tmp_path, hello_path):
+    # Create an archive which requires a decompressor
+    archive = shzip("-z", hello_path)
+
+    # Pipe the archive to a shell which can not find any commands
+    extraction_path = str(tmp_path / "extract")
+    process = subprocess.run(["/bin/sh"], input=archive, env={"TARGET": extraction_path, "PATH": str(tmp_path / "empty")}, capture_output=True)
+
+    # Make sure the archive exited before extracting anything
+    assert process.returncode == 127
+    assert not os.path.exists(extraction_path)
+
+
+@pytest.mark.parametrize("count", [1, 5, 10])
+def test_archive_multiple_files(shell, tmp_path, count):
+    # Draw the random data for all files at once
+    temp_data = memoryview(os.urandom(sum(11 * index for index in range(count))))
+
+    # Pair every temporary file with its slice of the data
+    temp_files = [(str(tmp_path / f"file{index}"), temp_data[11 * index * (index - 1) // 2:11 * index * (index + 1) // 2]) for index in range(count)]
+
+    # Create temporary files concurrently
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(write_file, *zip(*temp_files)))
+
+    # List of temporary files
+    temp_paths = [temp_path for temp_path, _ in temp_files]
 
     # Extract one of the archives
-    extraction_path = extract(contents=shzip(*temp_paths))
+    extraction_path = extract(shell, str(tmp_path / "extract"), contents=shzip(*temp_paths))
 
     # Make sure the files exists
     for temp_path in temp_paths:
         assert os.path.isfile(os.path.join(extraction_path, temp_path.lstrip("./")))
 
 
-def test_archive_reproducable():
+def test_archive_reproducable(shell, tmp_path):
     # Create temporary file
-    temp_path = tempfile.mktemp()
+    temp_path = str(tmp_path / "file")
 
     # Write some data to the file
     with open(temp_path, "wb") as file:
@@ -132,153 +321,180 @@ def test_archive_reproducable():
     assert archive_1 == archive_2
 
     # Extract one of the archives
-    extraction_path = extract(contents=archive_1)
+    extraction_path = extract(shell, str(tmp_path / "extract"), contents=archive_1)
 
     # Calculate md5sum before archive
-    with open(temp_path, "rb") as file:
-        original_md5sum = hashlib.md5(file.read()).digest()
+    original_md5sum = md5sum(temp_path)
 
     # Calculate after md5sum
-    with open(os.path.join(extraction_path, temp_path.lstrip("./")), "rb") as file:
-        extracted_md5sum = hashlib.md5(file.read()).digest()
+    extracted_md5sum = md5sum(os.path.join(extraction_path, temp_path.lstrip("./")))
 
     # Make sure md5sums match
     assert extracted_md5sum == original_md5sum
 
 
-def test_archive_non_reproducable():
+def test_archive_non_reproducable(shell, tmp_path):
     # Create temporary file
-    temp_path = tempfile.mktemp()
+    temp_path = str(tmp_path / "file")
 
     # Write some data to the file
     with open(temp_path, "wb") as file:
         file.write(os.urandom(1024))
 
-    # Archive the files
+    # Archive the file
+    archive = shzip(temp_path)
+
+    # Extract the archive
+    extraction_path = extract(shell, str(tmp_path / "extract"), contents=archive)
+
+    # Calculate md5sum before archive
+    original_md5sum = md5sum(temp_path)
+
+    # Calculate after md5sum
+    extracted_md5sum = md5sum(os.path.join(extraction_path, temp_path.lstrip("./")))
+
+    # Make sure md5sums match
+    assert extracted_md5sum == original_md5sum
+
+
+@pytest.mark.slow
+def test_archive_non_reproducable_size(tmp_path):
+    # Create temporary file
+    temp_path = str(tmp_path / "file")
+
+    # Write some data to the file
+    with open(temp_path, "wb") as file:
+        file.write(os.urandom(1024))
+
+    # Archive the file twice
     archive_1 = shzip(temp_path)
     archive_2 = shzip(temp_path)
 
     # Archives should be the same size
     assert len(archive_1) == len(archive_2)
 
-    # Extract one of the archives
-    extraction_path = extract(contents=archive_1)
+    # Archives should use different separation magics
+    assert archive_1 != archive_2
+
+
+@pytest.mark.parametrize("repetitions", [1, 10, pytest.param(256, marks=pytest.mark.slow)])
+def test_archive_integrity_plain(shell, tmp_path, repetitions):
+    # Create temporary file
+    temp_path = str(tmp_path / "file")
+
+    # Write some data to the file
+    with open(temp_path, "wb") as file:
+        file.write(bytes(range(256)) * repetitions)
 
     # Calculate md5sum before archive
-    with open(temp_path, "rb") as file:
-        original_md5sum = hashlib.md5(file.read()).digest()
+    original_md5sum = md5sum(temp_path)
+
+    # Create and extract the archive
+    extraction_path = extract(shell, str(tmp_path / "extract"), contents=shzip(temp_path))
 
     # Calculate after md5sum
-    with open(os.path.join(extraction_path, temp_path.lstrip("./")), "rb") as file:
-        extracted_md5sum = hashlib.md5(file.read()).digest()
+    extracted_md5sum = md5sum(os.path.join(extraction_path, temp_path.lstrip("./")))
 
     # Make sure md5sums match
     assert extracted_md5sum == original_md5sum
 
 
-def test_archive_integrity_plain():
+def test_archive_integrity_gzip(shell, tmp_path):
     # Create temporary file
-    temp_path = tempfile.mktemp()
+    temp_path = str(tmp_path / "file")
 
     # Write some data to the file
     with open(temp_path, "wb") as file:
-        file.write(bytearray([x for x in range(256)] * 10))
+        file.write(bytes(range(256)) * 10)
 
     # Calculate md5sum before archive
-    with open(temp_path, "rb") as file:
-        original_md5sum = hashlib.md5(file.read()).digest()
+    original_md5sum = md5sum(temp_path)
 
     # Create and extract the archive
-    extraction_path = extract(contents=shzip(temp_path))
+    extraction_path = extract(shell, str(tmp_path / "extract"), contents=shzip("-z", temp_path))
 
     # Calculate after md5sum
-    with open(os.path.join(extraction_path, temp_path.lstrip("./")), "rb") as file:
-        extracted_md5sum = hashlib.md5(file.read()).digest()
+    extracted_md5sum = md5sum(os.path.join(extraction_path, temp_path.lstrip("./")))
 
     # Make sure md5sums match
     assert extracted_md5sum == original_md5sum
 
 
-def test_archive_integrity_gzip():
+def test_archive_integrity_bzip2(shell, tmp_path):
     # Create temporary file
-    temp_path = tempfile.mktemp()
+    temp_path = str(tmp_path / "file")
 
     # Write some data to the file
     with open(temp_path, "wb") as file:
-        file.write(bytearray([x for x in range(256)] * 10))
+        file.write(bytes(range(256)) * 10)
 
     # Calculate md5sum before archive
-    with open(temp_path, "rb") as file:
-        original_md5sum = hashlib.md5(file.read()).digest()
+    original_md5sum = md5sum(temp_path)
 
     # Create and extract the archive
-    extraction_path = extract(contents=shzip("-z", temp_path))
+    extraction_path = extract(shell, str(tmp_path / "extract"), contents=shzip("-j", temp_path))
 
     # Calculate after md5sum
-    with open(os.path.join(extraction_path, temp_path.lstrip("./")), "rb") as file:
-        extracted_md5sum = hashlib.md5(file.read()).digest()
+    extracted_md5sum = md5sum(os.path.join(extraction_path, temp_path.lstrip("./")))
 
     # Make sure md5sums match
     assert extracted_md5sum == original_md5sum
 
 
-def test_archive_integrity_bzip2():
+def test_archive_integrity_xz(shell, tmp_path):
     # Create temporary file
-    temp_path = tempfile.mktemp()
+    temp_path = str(tmp_path / "file")
 
     # Write some data to the file
     with open(temp_path, "wb") as file:
-        file.write(bytearray([x for x in range(256)] * 10))
+        file.write(bytes(range(256)) * 10)
 
     # Calculate md5sum before archive
-    with open(temp_path, "rb") as file:
-        original_md5sum = hashlib.md5(file.read()).digest()
+    original_md5sum = md5sum(temp_path)
 
     # Create and extract the archive
-    extraction_path = extract(contents=shzip("-j", temp_path))
+    extraction_path = extract(shell, str(tmp_path / "extract"), contents=shzip("-J", temp_path))
 
     # Calculate after md5sum
-    with open(os.path.join(extraction_path, temp_path.lstrip("./")), "rb") as file:
-        extracted_md5sum = hashlib.md5(file.read()).digest()
+    extracted_md5sum = md5sum(os.path.join(extraction_path, temp_path.lstrip("./")))
 
     # Make sure md5sums match
     assert extracted_md5sum == original_md5sum
 
 
-def test_archive_integrity_xz():
+@pytest.mark.skipif(not shutil.which("zstd") or not importlib.util.find_spec("zstandard"), reason="zstd is not available")
+def test_archive_integrity_zstd(shell, tmp_path):
     # Create temporary file
-    temp_path = tempfile.mktemp()
+    temp_path = str(tmp_path / "file")
 
     # Write some data to the file
     with open(temp_path, "wb") as file:
-        file.write(bytearray([x for x in range(256)] * 10))
+        file.write(bytes(range(256)) * 10)
 
     # Calculate md5sum before archive
-    with open(temp_path, "rb") as file:
-        original_md5sum = hashlib.md5(file.read()).digest()
+    original_md5sum = md5sum(temp_path)
 
     # Create and extract the archive
-    extraction_path = extract(contents=shzip("-J", temp_path))
+    extraction_path = extract(shell, str(tmp_path / "extract"), contents=shzip("--zstd", temp_path))
 
     # Calculate after md5sum
-    with open(os.path.join(extraction_path, temp_path.lstrip("./")), "rb") as file:
-        extracted_md5sum = hashlib.md5(file.read()).digest()
+    extracted_md5sum = md5sum(os.path.join(extraction_path, temp_path.lstrip("./")))
 
     # Make sure md5sums match
     assert extracted_md5sum == original_md5sum
 
 
-def test_archive_integrity_incremental():
+def test_archive_integrity_incremental(shell, tmp_path):
     # List of temporary files
     temp_paths = {}
 
     # Create temporary files
     for index in range(256):
         # Create current path
-        temp_path = tempfile.mktemp()
+        temp_path = str(tmp_path / f"file{index}")
 
         # Create temporary data
-        temp_data = bytes([x for x in range(index)])
+        temp_data = bytes(range(index))
 
         # Write to the file
         with open(temp_path, "wb") as file:
@@ -288,12 +504,240 @@ def test_archive_integrity_incremental():
         temp_paths[temp_path] = hashlib.md5(temp_data).digest()
 
     # Create and extract the archive
-    extraction_path = extract(contents=shzip(*temp_paths.keys()))
+    extraction_path = extract(shell, str(tmp_path / "extract"), contents=shzip(*temp_paths.keys()))
 
     # Calculate after md5sum
     for temp_path, expected_md5sum in temp_paths.items():
-        with open(os.path.join(extraction_path, temp_path.lstrip("./")), "rb") as file:
-            extracted_md5sum = hashlib.md5(file.read()).digest()
+        extracted_md5sum = md5sum(os.path.join(extraction_path, temp_path.lstrip("./")))
 
         # Make sure md5sums match
         assert extracted_md5sum == expected_md5sum
+
+
+def test_archive_integrity_special_characters(shell, tmp_path):
+    # Create temporary file
+    temp_path = str(tmp_path / "file")
+
+    # Write some data the shell would otherwise interpret to the file
+    with open(temp_path, "wb") as file:
+        file.write(b"$HOME\\$(id)`id`\\")
+
+    # Calculate md5sum before archive
+    original_md5sum = md5sum(temp_path)
+
+    # Create and extract the archive
+    extraction_path = extract(shell, str(tmp_path / "extract"), contents=shzip(temp_path))
+
+    # Calculate after md5sum
+    extracted_md5sum = md5sum(os.path.join(extraction_path, temp_path.lstrip("./")))
+
+    # Make sure md5sums match
+    assert extracted_md5sum == original_md5sum
+
+
+@pytest.mark.parametrize("compression", [[], ["-z"]])
+def test_archive_parallel(tmp_path, monkeypatch, compression):
+    # List of temporary files
+    temp_paths = []
+
+    # Create temporary files, both binary and text
+    for index in range(20):
+        # Create current path
+        temp_path = str(tmp_path / f"file{index}")
+
+        # Write to the file
+        with open(temp_path, "wb") as file:
+            file.write(os.urandom(1024 * index) if index % 2 else b"Hello World!\n" * 1024 * index)
+
+        # Append the path to the list
+        temp_paths.append(temp_path)
+
+    # Pretend there are enough CPUs for the requested jobs, shzip caps the jobs by the CPU count
+    monkeypatch.setattr(os, "cpu_count", lambda: 8)
+
+    # Record the files dumped by the thread pool
+    dumped_paths, dump_file = [], shzip_module.dump_file
+    monkeypatch.setattr(shzip_module, "dump_file", lambda path, *args: dumped_paths.append(path) or dump_file(path, *args))
+
+    # Archive the files both serially and concurrently
+    archive_1 = shzip("--reproducable", "--jobs", "1", *compression, *temp_paths)
+    archive_2 = shzip("--reproducable", "--jobs", "4", *compression, *temp_paths)
+
+    # Make sure the files were archived concurrently, only observable in-process
+    assert SUBPROCESS or len(dumped_paths) == len(temp_paths)
+
+    # Archives should be the same
+    assert archive_1 == archive_2
+
+
+@pytest.mark.skipif(SUBPROCESS, reason="the thread pool is only observable in-process")
+@pytest.mark.parametrize("compression, concurrent", [([], False), (["-z"], True)])
+def test_archive_parallel_default(tmp_path, monkeypatch, compression, concurrent):
+    # List of temporary files
+    temp_paths = []
+
+    # Create temporary files
+    for index in range(10):
+        # Create current path
+        temp_path = str(tmp_path / f"file{index}")
+
+        # Write to the file
+        with open(temp_path, "wb") as file:
+            file.write(b"Hello World!\n" * index)
+
+        # Append the path to the list
+        temp_paths.append(temp_path)
+
+    # Pretend there are enough CPUs to archive concurrently
+    monkeypatch.setattr(os, "cpu_count", lambda: 8)
+
+    # Record the files dumped by the thread pool
+    dumped_paths, dump_file = [], shzip_module.dump_file
+    monkeypatch.setattr(shzip_module, "dump_file", lambda path, *args: dumped_paths.append(path) or dump_file(path, *args))
+
+    # Archive the files without specifying the number of jobs
+    shzip(*compression, *temp_paths)
+
+    # Make sure only compressed archives are created concurrently by default
+    assert bool(dumped_paths) == concurrent
+
+
+@pytest.mark.skipif(SUBPROCESS, reason="the thread pool is only observable in-process")
+def test_archive_parallel_failure(tmp_path, monkeypatch):
+    # List of temporary files
+    temp_paths = []
+
+    # Create temporary files
+    for index in range(20):
+        # Create current path
+        temp_path = str(tmp_path / f"file{index}")
+
+        # Write to the file
+        with open(temp_path, "wb") as file:
+            file.write(os.urandom(1024 * index))
+
+        # Append the path to the list
+        temp_paths.append(temp_path)
+
+    # Pretend there are enough CPUs for the requested jobs
+    monkeypatch.setattr(os, "cpu_count", lambda: 8)
+
+    # Record the temporary files created, and fail on one of the first files
+    temporary_files, dump_file = [], shzip_module.dump_file
+
+    def failing_dump_file(path, *args):
+        # Fail on a file while later files are in flight
+        if path == temp_paths[1]:
+            raise OSError("Failed to read file")
+
+        # Keep the temporary file to check it was closed
+        temporary_file = dump_file(path, *args)
+        temporary_files.append(temporary_file)
+        return temporary_file
+
+    monkeypatch.setattr(shzip_module, "dump_file", failing_dump_file)
+
+    # Make sure the failure is raised
+    with pytest.raises(OSError):
+        shzip("--jobs", "4", *temp_paths)
+
+    # Make sure no temporary file was left open
+    assert temporary_files and all(temporary_file.closed for temporary_file in temporary_files)
+
+
+def test_archive_text_unencoded(shell, tmp_path):
+    # Create temporary file
+    temp_path = str(tmp_path / "file")
+
+    # Write some text to the file
+    with open(temp_path, "w") as file:
+        file.write("Hello World!\n\tHello again\n\n")
+
+    # Archive the file
+    archive = shzip(temp_path)
+
+    # Make sure the text was not encoded
+    assert b"Hello World!\n\tHello again\n\n" in archive
+
+    # Extract the archive
+    extraction_path = extract(shell, str(tmp_path / "extract"), contents=archive)
+
+    # Make sure the contents match
+    with open(os.path.join(extraction_path, temp_path.lstrip("./")), "r") as file:
+        assert file.read() == "Hello World!\n\tHello again\n\n"
+
+
+def test_archive_text_containing_magic(shell, tmp_path):
+    # Create temporary file
+    temp_path = str(tmp_path / "file")
+
+    # Write some text containing the reproducable separation magic to the file
+    with open(temp_path, "w") as file:
+        file.write("Hello\nSHZIP_EOF\nWorld\nSHZIP_EOF")
+
+    # Archive the file
+    archive = shzip("--reproducable", temp_path)
+
+    # Make sure another separation magic was picked instead of encoding the text
+    assert b"Hello\nSHZIP_EOF\nWorld\nSHZIP_EOF" in archive
+
+    # Extract the archive
+    extraction_path = extract(shell, str(tmp_path / "extract"), contents=archive)
+
+    # Make sure the contents match
+    with open(os.path.join(extraction_path, temp_path.lstrip("./")), "r") as file:
+        assert file.read() == "Hello\nSHZIP_EOF\nWorld\nSHZIP_EOF"
+
+
+def test_archive_text_containing_magics(shell, tmp_path):
+    # Create temporary file
+    temp_path = str(tmp_path / "file")
+
+    # Write some text containing the first few reproducable separation magics to the file
+    with open(temp_path, "w") as file:
+        file.write("SHZIP_EOF_1\nHello\nSHZIP_EOF\nWorld\nSHZIP_EOF_2")
+
+    # Archive the file
+    archive = shzip("--reproducable", temp_path)
+
+    # Make sure the first magic not appearing in the text was picked
+    assert b"<< SHZIP_EOF_3\n" in archive
+
+    # Extract the archive
+    extraction_path = extract(shell, str(tmp_path / "extract"), contents=archive)
+
+    # Make sure the contents match
+    with open(os.path.join(extraction_path, temp_path.lstrip("./")), "r") as file:
+        assert file.read() == "SHZIP_EOF_1\nHello\nSHZIP_EOF\nWorld\nSHZIP_EOF_2"
+
+
+def test_archive_hardlinks(shell, tmp_path):
+    # Create temporary directory
+    temp_path = str(tmp_path / "directory")
+    os.mkdir(temp_path)
+
+    # Write some data to a file
+    with open(os.path.join(temp_path, "original"), "wb") as file:
+        file.write(os.urandom(1024))
+
+    # Create a hardlink to the file
+    os.link(os.path.join(temp_path, "original"), os.path.join(temp_path, "hardlink"))
+
+    # Archive the directory
+    archive = shzip(temp_path)
+
+    # Make sure the contents were only archived once
+    assert archive.count(b"<<") == 1
+
+    # Make sure the smallest path was archived, regardless of the traversal order
+    assert b"/hardlink <<" in archive
+
+    # Extract the archive
+    extraction_path = extract(shell, str(tmp_path / "extract"), contents=archive)
+
+    # Stat both extracted files
+    original_stat = os.stat(os.path.join(extraction_path, temp_path.lstrip("./"), "original"))
+    hardlink_stat = os.stat(os.path.join(extraction_path, temp_path.lstrip("./"), "hardlink"))
+
+    # Make sure the files are linked
+    assert original_stat.st_ino == hardlink_stat.st_ino